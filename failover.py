@@ -11,9 +11,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import itertools
+import time
+
 from ryu.base import app_manager
 from ryu.controller import ofp_event
 from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER
+from ryu.controller.handler import DEAD_DISPATCHER
 from ryu.controller.handler import set_ev_cls
 from ryu.ofproto import ofproto_v1_3
 from ryu.lib.packet import packet
@@ -21,6 +25,19 @@ from ryu.lib.packet import ethernet
 from ryu.lib.packet import ether_types
 from ryu.lib import hub
 
+# (idle_timeout, hard_timeout) per flow class; 0 means never expire
+FLOW_TIMEOUTS = {
+    'static': (0, 0),
+    'reactive': (30, 300),
+}
+# Only these classes may be evicted when a table runs full
+EVICTABLE_CLASSES = ('reactive',)
+
+FLOW_TABLE_CAPACITY = 1000      # used until the switch reports max_entries
+FLOW_TABLE_HIGH_WATERMARK = 0.9 # start evicting above this occupancy
+FLOW_TABLE_LOW_WATERMARK = 0.8  # evict until back below this occupancy
+FLOW_STATS_INTERVAL = 10        # seconds between flow/table stats polls
+
 
 class ProactiveProtocolSwitch(app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
@@ -31,6 +48,21 @@ class ProactiveProtocolSwitch(app_manager.RyuApp):
         self.prev_port_bytes = {}   # (dpid, port_no) -> (tx_bytes, timestamp)
         self.pollers = {}
         self.datapaths = {}
+        # dpid -> table_id -> cookie -> entry dict
+        self.flow_tables = {}
+        # dpid -> (table_id, priority, match) -> cookie
+        self.flow_index = {}
+        # dpid -> xid of an unconfirmed flow-mod -> (table_id, cookie)
+        self.pending_flow_mods = {}
+        # dpid -> (request time, cookies seen so far) of a running flow dump
+        self.flow_dumps = {}
+        # (dpid, table_id) -> max_entries from the switch's table features
+        self.table_capacity = {}
+        # (dpid, table_id) already warned about having nothing to evict
+        self.eviction_warned = set()
+        # Upper cookie bits are per-run so stale FlowRemoved messages for
+        # flows from an earlier controller run never match a tracked entry
+        self.cookies = itertools.count(((int(time.time()) & 0xffffffff) << 32) + 1)
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
     def switch_features_handler(self, ev):
@@ -39,9 +71,35 @@ class ProactiveProtocolSwitch(app_manager.RyuApp):
         self.datapaths[datapath.id] = datapath
         self.install_protocol_flows(datapath)
 
-        if datapath.id not in self.pollers:
-            g = hub.spawn(self._poll_stats, datapath)
-            self.pollers[datapath.id] = g
+        parser = datapath.ofproto_parser
+        datapath.send_msg(parser.OFPTableFeaturesStatsRequest(datapath, 0, []))
+
+        # A reconnecting switch gets a new Datapath, so restart its poller
+        poller = self.pollers.pop(datapath.id, None)
+        if poller is not None:
+            hub.kill(poller)
+        self.pollers[datapath.id] = hub.spawn(self._poll_stats, datapath)
+
+    @set_ev_cls(ofp_event.EventOFPStateChange, DEAD_DISPATCHER)
+    def state_change_handler(self, ev):
+        datapath = ev.datapath
+        dpid = datapath.id
+
+        # Ignore an old connection going away after the switch reconnected
+        if dpid is None or self.datapaths.get(dpid) is not datapath:
+            return
+
+        self.logger.info("Switch disconnected: dpid=%s", dpid)
+        poller = self.pollers.pop(dpid, None)
+        if poller is not None:
+            hub.kill(poller)
+        del self.datapaths[dpid]
+        self.forget_flows(dpid)
+        self.table_capacity = {key: capacity
+                               for key, capacity in self.table_capacity.items()
+                               if key[0] != dpid}
+        self.eviction_warned = {key for key in self.eviction_warned
+                                if key[0] != dpid}
 
     def install_protocol_flows(self, datapath):
         ofproto = datapath.ofproto
@@ -154,27 +212,240 @@ class ProactiveProtocolSwitch(app_manager.RyuApp):
         match = parser.OFPMatch()
         mod = parser.OFPFlowMod(
             datapath=datapath,
+            table_id=ofproto.OFPTT_ALL,
             command=ofproto.OFPFC_DELETE,
             out_port=ofproto.OFPP_ANY,
             out_group=ofproto.OFPG_ANY,
             match=match
         )
         datapath.send_msg(mod)
+        self.forget_flows(datapath.id)
         self.logger.info("Cleared all flows from switch %s", datapath.id)
 
-    def add_flow(self, datapath, priority, match, actions, buffer_id=None):
+    def forget_flows(self, dpid):
+        self.flow_tables.pop(dpid, None)
+        self.flow_index.pop(dpid, None)
+        self.pending_flow_mods.pop(dpid, None)
+        self.flow_dumps.pop(dpid, None)
+
+    def add_flow(self, datapath, priority, match, actions, buffer_id=None,
+                 flow_class='static', table_id=0):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
 
+        idle_timeout, hard_timeout = FLOW_TIMEOUTS[flow_class]
+        cookie = self.track_flow(datapath, table_id, priority, match, flow_class)
+
+        # Permanent flows only go away on an explicit clear, which already
+        # drops their tracking, so only ask about flows that can expire
+        flags = 0
+        if idle_timeout or hard_timeout or flow_class in EVICTABLE_CLASSES:
+            flags = ofproto.OFPFF_SEND_FLOW_REM
+
         inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, actions)]
+        kwargs = dict(datapath=datapath, cookie=cookie, table_id=table_id,
+                      idle_timeout=idle_timeout, hard_timeout=hard_timeout,
+                      priority=priority, flags=flags,
+                      match=match, instructions=inst)
         if buffer_id:
-            mod = parser.OFPFlowMod(datapath=datapath, buffer_id=buffer_id,
-                                    priority=priority, match=match, instructions=inst)
-        else:
-            mod = parser.OFPFlowMod(datapath=datapath, priority=priority,
-                                    match=match, instructions=inst)
+            kwargs['buffer_id'] = buffer_id
+        mod = parser.OFPFlowMod(**kwargs)
+
+        # Remember the xid so a rejected flow-mod can be untracked again
+        datapath.set_xid(mod)
+        self.flow_tables[datapath.id][table_id][cookie]['xid'] = mod.xid
+        self.pending_flow_mods.setdefault(datapath.id, {})[mod.xid] = (table_id, cookie)
         datapath.send_msg(mod)
 
+    def track_flow(self, datapath, table_id, priority, match, flow_class):
+        """Record a flow about to be installed and return its cookie"""
+        dpid = datapath.id
+        table = self.flow_tables.setdefault(dpid, {}).setdefault(table_id, {})
+        index = self.flow_index.setdefault(dpid, {})
+
+        # An add with the same table/priority/match overwrites the old entry
+        key = (table_id, priority, str(match))
+        old_cookie = index.get(key)
+        if old_cookie is not None:
+            self.untrack_flow(dpid, table_id, old_cookie)
+
+        cookie = next(self.cookies)
+        now = time.monotonic()
+        table[cookie] = {
+            'key': key,
+            'flow_class': flow_class,
+            'installed': now,
+            'last_hit': now,
+            'byte_count': 0,
+            'byte_rate': 0.0,
+            'polled': now,
+            'xid': None,
+        }
+        index[key] = cookie
+        return cookie
+
+    def untrack_flow(self, dpid, table_id, cookie):
+        table = self.flow_tables.get(dpid, {}).get(table_id, {})
+        entry = table.pop(cookie, None)
+        if entry is None:
+            return None
+        index = self.flow_index.get(dpid, {})
+        if index.get(entry['key']) == cookie:
+            del index[entry['key']]
+        self.pending_flow_mods.get(dpid, {}).pop(entry['xid'], None)
+        return entry
+
+    def evict_flows(self, datapath, table_id, occupancy):
+        """Remove the least valuable evictable flows from a full table"""
+        dpid = datapath.id
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        capacity = self.table_capacity.get((dpid, table_id), FLOW_TABLE_CAPACITY)
+        high = int(capacity * FLOW_TABLE_HIGH_WATERMARK)
+        low = int(capacity * FLOW_TABLE_LOW_WATERMARK)
+        if occupancy <= high:
+            self.eviction_warned.discard((dpid, table_id))
+            return
+
+        table = self.flow_tables.get(dpid, {}).get(table_id, {})
+        # Flows without a stats sample yet have no byte rate to judge them by
+        candidates = [(entry['byte_rate'], entry['last_hit'], cookie)
+                      for cookie, entry in table.items()
+                      if entry['flow_class'] in EVICTABLE_CLASSES
+                      and entry['polled'] != entry['installed']]
+        candidates.sort()
+        victims = candidates[:occupancy - low]
+
+        if len(victims) < occupancy - low and (dpid, table_id) not in self.eviction_warned:
+            self.eviction_warned.add((dpid, table_id))
+            self.logger.warning("Switch %s table %s still above watermark: "
+                                "not enough evictable flows", dpid, table_id)
+        if not victims:
+            return
+
+        for _, _, cookie in victims:
+            mod = parser.OFPFlowMod(datapath=datapath, table_id=table_id,
+                                    command=ofproto.OFPFC_DELETE,
+                                    cookie=cookie, cookie_mask=0xffffffffffffffff,
+                                    out_port=ofproto.OFPP_ANY,
+                                    out_group=ofproto.OFPG_ANY,
+                                    match=parser.OFPMatch())
+            datapath.send_msg(mod)
+            self.untrack_flow(dpid, table_id, cookie)
+
+        self.logger.info("Evicted %d flows from switch %s table %s "
+                         "(occupancy %d/%d)", len(victims), dpid, table_id,
+                         occupancy, capacity)
+
+    @set_ev_cls(ofp_event.EventOFPErrorMsg, [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def error_msg_handler(self, ev):
+        msg = ev.msg
+        dp = msg.datapath
+        ofproto = dp.ofproto
+
+        if msg.type != ofproto.OFPET_FLOW_MOD_FAILED:
+            return
+
+        pending = self.pending_flow_mods.get(dp.id, {}).pop(msg.xid, None)
+        if pending is None:
+            return
+
+        table_id, cookie = pending
+        entry = self.untrack_flow(dp.id, table_id, cookie)
+        if msg.code == ofproto.OFPFMFC_TABLE_FULL:
+            reason = 'table full'
+        else:
+            reason = 'code %d' % msg.code
+
+        self.logger.warning("Flow-mod rejected by switch %s table %s: %s "
+                            "(cookie=%s class=%s)", dp.id, table_id, reason,
+                            cookie, entry['flow_class'] if entry else None)
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def flow_removed_handler(self, ev):
+        msg = ev.msg
+        dp = msg.datapath
+        ofproto = dp.ofproto
+
+        entry = self.untrack_flow(dp.id, msg.table_id, msg.cookie)
+        if entry is None:
+            return
+
+        if msg.reason == ofproto.OFPRR_IDLE_TIMEOUT:
+            reason = 'idle timeout'
+        elif msg.reason == ofproto.OFPRR_HARD_TIMEOUT:
+            reason = 'hard timeout'
+        elif msg.reason == ofproto.OFPRR_DELETE:
+            reason = 'delete'
+        else:
+            reason = 'unknown'
+
+        self.logger.debug("Flow removed from switch %s table %s: cookie=%s "
+                          "class=%s reason=%s bytes=%d", dp.id, msg.table_id,
+                          msg.cookie, entry['flow_class'], reason,
+                          msg.byte_count)
+
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER)
+    def flow_stats_reply_handler(self, ev):
+        msg = ev.msg
+        dpid = msg.datapath.id
+        tables = self.flow_tables.get(dpid, {})
+        now = time.monotonic()
+        dump = self.flow_dumps.get(dpid)
+
+        for stat in msg.body:
+            if dump is not None:
+                dump[1].add(stat.cookie)
+
+            entry = tables.get(stat.table_id, {}).get(stat.cookie)
+            if entry is None:
+                continue
+
+            # The switch has the flow, so its flow-mod can no longer fail
+            self.pending_flow_mods.get(dpid, {}).pop(entry['xid'], None)
+
+            delta_bytes = stat.byte_count - entry['byte_count']
+            delta_time = now - entry['polled']
+            if delta_bytes > 0:
+                entry['last_hit'] = now
+            entry['byte_rate'] = delta_bytes / delta_time if delta_time > 0 else 0.0
+            entry['byte_count'] = stat.byte_count
+            entry['polled'] = now
+
+        if msg.flags & msg.datapath.ofproto.OFPMPF_REPLY_MORE or dump is None:
+            return
+
+        # Full dump received: forget flows that vanished without a
+        # FlowRemoved, but not ones installed after the request went out
+        del self.flow_dumps[dpid]
+        requested, seen = dump
+        stale = [(table_id, cookie)
+                 for table_id, table in tables.items()
+                 for cookie, entry in table.items()
+                 if cookie not in seen and entry['installed'] < requested]
+        for table_id, cookie in stale:
+            self.untrack_flow(dpid, table_id, cookie)
+        if stale:
+            self.logger.info("Dropped %d stale flow entries for switch %s",
+                             len(stale), dpid)
+
+    @set_ev_cls(ofp_event.EventOFPTableFeaturesStatsReply, MAIN_DISPATCHER)
+    def table_features_reply_handler(self, ev):
+        msg = ev.msg
+        dpid = msg.datapath.id
+
+        for stat in msg.body:
+            self.table_capacity[(dpid, stat.table_id)] = stat.max_entries
+
+    @set_ev_cls(ofp_event.EventOFPTableStatsReply, MAIN_DISPATCHER)
+    def table_stats_reply_handler(self, ev):
+        msg = ev.msg
+        dp = msg.datapath
+
+        for stat in msg.body:
+            self.evict_flows(dp, stat.table_id, stat.active_count)
+
     @set_ev_cls(ofp_event.EventOFPPortStatsReply, MAIN_DISPATCHER)
     def port_stats_reply_handler(self, ev):
         msg = ev.msg
@@ -209,15 +480,20 @@ class ProactiveProtocolSwitch(app_manager.RyuApp):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
 
-        self.logger.info("Starting port stats polling thread for switch %s", datapath.id)
+        self.logger.info("Starting stats polling thread for switch %s", datapath.id)
 
-        while True:
+        for tick in itertools.count():
             try:
                 # Request stats only for port 2
                 req = parser.OFPPortStatsRequest(datapath, 0, 2)
                 datapath.send_msg(req)
+
+                if tick % FLOW_STATS_INTERVAL == 0:
+                    self.flow_dumps[datapath.id] = (time.monotonic(), set())
+                    datapath.send_msg(parser.OFPFlowStatsRequest(datapath))
+                    datapath.send_msg(parser.OFPTableStatsRequest(datapath, 0))
             except Exception as e:
-                self.logger.exception("Exception while sending port stats request: %s", e)
+                self.logger.exception("Exception while sending stats request: %s", e)
             hub.sleep(1)
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)